@@ -3,7 +3,6 @@ import numpy as np
 import scipy.stats
 import scipy
 from scipy.stats import norm
-import numpy.ma as ma
 import time
 import IPython
 import matplotlib as mpl
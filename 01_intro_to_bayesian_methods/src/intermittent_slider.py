@@ -2,12 +2,12 @@ import tkanvas
 import argparse
 from tkanvas import TKanvas
 import numpy as np
-import numpy.ma as ma
 import time
+import math
 import slider_filter
 import sys
 import os
-import csv
+import atexit
 
 
 class Gilbert(object):
@@ -18,18 +18,29 @@ class Gilbert(object):
         self.p1 = p1
         self.p2 = p2
         self.state = 0
-
-    def update(self, dt):
-        # account for sampling rate
-        p1 = 1 - ((1 - self.p1) ** (dt))
-        p2 = 1 - ((1 - self.p2) ** (dt))
+        # log(1-p) for each transition, so rescaling to dt is one exp;
+        # a certain transition (p == 1) stays certain for any dt
+        self._l1 = math.log1p(-p1) if p1 < 1 else -math.inf
+        self._l2 = math.log1p(-p2) if p2 < 1 else -math.inf
+        self._dt = None
+
+    def update(self, dt, u=None):
+        """Step the chain by dt. ``u`` is an optional U(0,1) draw to use
+        for the transition; if omitted, one is taken from np.random"""
+        if u is None:
+            u = np.random.random()
+        # account for sampling rate; dt barely changes from frame
+        # to frame, so only recompute the probabilities when it does
+        if self._dt is None or abs(dt - self._dt) > 1e-4:
+            self._dt = dt
+            self._p1 = -math.expm1(self._l1 * dt)
+            self._p2 = -math.expm1(self._l2 * dt)
 
         if self.state == 0:
-            if np.random.random() < p1:
+            if u < self._p1:
                 self.state = 1
-        if self.state == 1:
-            if np.random.random() < p2:
-                self.state = 0
+        elif u < self._p2:
+            self.state = 0
         return self.state
 
 
@@ -40,82 +51,99 @@ class Box:
         self.right = right
         self.prior = prior
         self.color = color
+        self.rgb = hex_to_rgb(color)
 
 
-def clamp(val, minimum=0, maximum=255):
-    if val < minimum:
-        return minimum
-    if val > maximum:
-        return maximum
-    return val
+def hex_to_rgb(hexstr):
+    """Parse a "#rrggbb" hex string into an (r, g, b) tuple of ints"""
+    hexstr = hexstr.strip("#")
+    return int(hexstr[:2], 16), int(hexstr[2:4], 16), int(hexstr[4:], 16)
 
 
-def colorscale(hexstr, scalefactor):
+def colorscale_table(rgb, levels=256):
     """
-    Scales a hex string by ``scalefactor``. Returns scaled hex string.
-
-    To darken the color, use a float value between 0 and 1.
-    To brighten the color, use a float value greater than 1.
+    Return a lookup table of ``levels`` hex strings, scaling
+    ``rgb`` from black (entry 0) to full brightness (entry levels-1).
 
-    >>> colorscale("#DF3C3C", .5)
-    #6F1E1E
-    >>> colorscale("#52D24F", 1.6)
-    #83FF7E
-    >>> colorscale("#4F75D2", 1)
-    #4F75D2
+    >>> colorscale_table((0xDF, 0x3C, 0x3C), 3)
+    ['#000000', '#6f1e1e', '#df3c3c']
     """
-
-    hexstr = hexstr.strip("#")
-
-    if scalefactor < 0 or len(hexstr) != 6:
-        return hexstr
-
-    r, g, b = int(hexstr[:2], 16), int(hexstr[2:4], 16), int(hexstr[4:], 16)
-
-    r = clamp(r * scalefactor)
-    g = clamp(g * scalefactor)
-    b = clamp(b * scalefactor)
-
-    return "#%02x%02x%02x" % (int(r), int(g), int(b))
+    scales = np.arange(levels) / (levels - 1)
+    table = np.clip(np.outer(scales, rgb), 0, 255).astype(np.uint8)
+    return ["#%02x%02x%02x" % (r, g, b) for r, g, b in table]
 
 
-def box_probability(particles, weights, boxes):
-    xs = particles[:, 0]
-    probs = []
-    for box in boxes:
-        # compute weight in each box
-        posterior = np.sum(
-            weights[np.logical_and(xs > box.left, xs < box.right)] * box.prior
-        )
-        probs.append(posterior)
-    probs = np.array(probs) + 1e-6
+def box_probability(xs, weights, edges, priors):
+    """Return the normalised posterior probability of each box, given
+    the sorted box ``edges`` (len(boxes)+1) and the box ``priors``."""
+    # bin every particle in one pass; bin 0 and bin len(edges) are
+    # the particles which fall outside of the slider
+    bins = np.searchsorted(edges, xs, side="right")
+    posterior = np.bincount(bins, weights=weights, minlength=len(edges) + 1)
+    probs = posterior[1 : len(edges)] * priors + 1e-6
 
     # normalise probabilities and return
     return probs / np.sum(probs)
 
 
 class SliderLogger:
+    # number of rows buffered before they are written out
+    FLUSH_N = 256
+
     def __init__(self, fields):
         time_name = "slider_{time}.csv".format(
             time=time.asctime().replace(" ", "_").replace(":", "_")
         )
         fname = os.path.join("..", "captured_data", time_name)
-        self.log_file = open(fname, "w")        
-        self.writer = csv.DictWriter(self.log_file, fieldnames=fields)
-        self.writer.writeheader()
-
+        self.log_file = open(fname, "w")
+        self.log_file.write(",".join(fields) + "\n")
+        self.field_index = {field: i for i, field in enumerate(fields)}
+        self._buf = np.empty((self.FLUSH_N, len(fields)), dtype=np.float64)
+        self._i = 0
+        # make sure buffered rows still reach disk if we are killed
+        # without going through quit (e.g. Ctrl-C in the terminal)
+        atexit.register(self.close)
 
     def log(self, **fields):
-        self.writer.writerow(fields)
+        row = self._buf[self._i]
+        for field, value in fields.items():
+            row[self.field_index[field]] = value
+        self._i += 1
+        if self._i == self.FLUSH_N:
+            self.flush()
+
+    def flush(self):
+        np.savetxt(self.log_file, self._buf[: self._i], delimiter=",", fmt="%.10g")
+        self._i = 0
 
     def close(self):
+        if self.log_file.closed:
+            return
+        self.flush()
         self.log_file.close()
 
 
 class SliderDemo(object):
     def __init__(self, boxes, args):
         self.boxes = boxes
+        # the boxes as parallel arrays, so the per-frame code never
+        # touches the Box objects
+        self.box_left = np.array([box.left for box in boxes])
+        self.box_right = np.array([box.right for box in boxes])
+        self.box_prior = np.array([box.prior for box in boxes])
+        self.box_colors = [box.color for box in boxes]
+        # boxes tile the slider, so the edges are every left plus the last right
+        self.box_edges = np.append(self.box_left, self.box_right[-1])
         self.screen_size = 1000
+        # fixed screen extents and faded colors of each box
+        self._box_px = list(
+            zip(
+                (self.box_left * self.screen_size).tolist(),
+                (self.box_right * self.screen_size).tolist(),
+                self.box_colors,
+            )
+        )
+        self._color_lut = [colorscale_table(box.rgb) for box in boxes]
         self.slider_height = 150
         self.canvas = TKanvas(
             draw_fn=self.draw,
@@ -141,17 +169,55 @@ class SliderDemo(object):
         )
         self.gilbert = Gilbert(0.5, 0.3)
         self.n_particles = 200
-        self.particles = slider_filter.prior(self.n_particles)
+        self.particles_x, self.particles_dx = slider_filter.prior(self.n_particles)
+        self.weights = np.empty(self.n_particles)
+        self.observation = np.empty(2)
         # self.canvas.root.config(cursor='none')
         self.show_particles = args.particles
         self.show_block = args.block
+        # std. dev. multiples, heights and stipples of the nested blocks
+        self.block_stds = np.array([0.5, 1, 2])
+        block_heights = np.array([0.75, 0.5, 0.25])
+        self.block_tops = (0.5 - 0.5 * block_heights) * self.slider_height
+        self.block_bottoms = (0.5 + 0.5 * block_heights) * self.slider_height
+        self.block_stipples = ("gray50", "gray25", "gray25")
         self.sampling_intermittency = args.sampling
         self.last_x = None
-        self.last_t = time.time()
-        self.start_time = time.time()
+        self.idle_frame_time = 1 / 30.0
+        self.last_t = time.perf_counter()
+        self.start_time = time.perf_counter()
         self.dx = 0
         self.x = 0
         self.position_noise = 0.03
+        self.refill_noise()
+        self.create_items()
+
+    def create_items(self):
+        """Create every canvas item once, bottom to top; draw() only
+        moves and recolors them"""
+        src = self.canvas
+        h = self.slider_height
+        self._box_ids = [
+            src.rectangle(left, 0, right, h, fill=color, outline=color)
+            for left, right, color in self._box_px
+        ]
+        self._box_fills = list(self.box_colors)
+        if self.show_block:
+            self._block_ids = [
+                src.rectangle(0, 0, 0, 0, fill="blue", stipple=stipple, width=0)
+                for stipple in self.block_stipples
+            ]
+        if self.show_particles:
+            self._particle_ids = [
+                src.circle(0, 0, 0, fill="grey") for _ in range(self.n_particles)
+            ]
+            self._expected_id = src.circle(0, h // 2, 5, fill="blue")
+            self._expected_line_id = src.line(0, 0, 0, h, fill="cyan", width=2)
+            self._var_line_ids = [
+                src.line(0, 0.25 * h, 0, 0.75 * h, fill="blue") for _ in range(2)
+            ]
+        self._observed_id = src.line(0, 0, 0, h, fill="white", width=5, state="hidden")
+        self._observed_state = "hidden"
 
     def quit(self, src):
         self.logger.close()
@@ -162,14 +228,29 @@ class SliderDemo(object):
         pass
 
     def update_filter(self):
-        observation = [self.observed_x if self.observed else np.nan, np.abs(self.dx)]
-
-        self.particles, self.weights = slider_filter.filter_step(
-            self.particles, observed=observation, dt=self.dt, prior_rate=0.00005
+        # observed (x, speed); x is NaN when the position was not sampled
+        observation = self.observation
+        observation[0] = self.observed_x if self.observed else np.nan
+        observation[1] = abs(self.dx)
+
+        slider_filter.filter_step(
+            self.particles_x,
+            self.particles_dx,
+            self.weights,
+            observed=observation,
+            dt=self.dt,
+            prior_rate=0.00005,
         )
 
+    def refill_noise(self, n=4096):
+        """Pre-draw a block of observation noise, Gilbert transition draws
+        and sampling coin flips, so that each frame only has to index into them"""
+        self._noise_buf = np.random.standard_normal(n)
+        self._uniform_buf = np.random.uniform(0, 1, (n, 2))
+        self._noise_i = 0
+
     def update_state(self, screen_x):
-        t = time.time()
+        t = time.perf_counter()
         self.x = screen_x / self.screen_size
 
         if self.last_x != None:
@@ -179,130 +260,123 @@ class SliderDemo(object):
         else:
             dt = 1 / 60.0
 
-        self.gilbert.update(dt)
+        if self._noise_i == len(self._noise_buf):
+            self.refill_noise()
+        noise = self._noise_buf[self._noise_i]
+        u_switch, u = self._uniform_buf[self._noise_i]
+        self._noise_i += 1
+
+        self.gilbert.update(dt, u_switch)
         self.t = t
         self.last_x = self.x
         self.last_t = t
         self.dt = dt
-        self.observed_x = self.x + np.random.normal(0, self.position_noise)
+        self.observed_x = self.x + noise * self.position_noise
 
         if self.gilbert.state == 0:
-            self.observed = np.random.uniform(0, 1) < 0.9
+            self.observed = u < 0.9
         else:
-            self.observed = np.random.uniform(0, 1) < self.sampling_intermittency
+            self.observed = u < self.sampling_intermittency
 
     def draw(self, src):
         screen_x = src.mouse_x
+        # while the mouse is still, only step the filter at a reduced rate
+        if (
+            screen_x / self.screen_size == self.last_x
+            and time.perf_counter() - self.last_t < self.idle_frame_time
+        ):
+            return
         self.update_state(screen_x)
         self.update_filter()
-        src.clear()
-
-        box_weights = box_probability(self.particles, self.weights, self.boxes)
-
-        for box, box_w in zip(self.boxes, box_weights):
-            screen_left = box.left * self.screen_size
-            screen_right = box.right * self.screen_size
-            # show fading boxes if in particle mode
-            if self.show_particles or self.show_block:
-                scaled_color = colorscale(box.color, box_w)
-                src.rectangle(
-                    screen_left,
-                    0,
-                    screen_right,
-                    self.slider_height,
-                    fill=scaled_color,
-                    outline=box.color,
-                )
-            else:
-                src.rectangle(
-                    screen_left,
-                    0,
-                    screen_right,
-                    self.slider_height,
-                    fill=box.color,
-                    outline=box.color,
-                )
 
-        expected_pos = slider_filter.expected_position(self.particles, self.weights)
-        expected_var = slider_filter.variance_position(self.particles, self.weights)
+        box_weights = box_probability(
+            self.particles_x, self.weights, self.box_edges, self.box_prior
+        )
+
+        # show fading boxes if in particle mode
+        if self.show_particles or self.show_block:
+            for i, box_w in enumerate(box_weights):
+                scaled_color = self._color_lut[i][min(255, int(box_w * 255))]
+                if scaled_color != self._box_fills[i]:
+                    src.modify(self._box_ids[i], fill=scaled_color)
+                    self._box_fills[i] = scaled_color
+
+        expected_pos, expected_var = slider_filter.mean_variance(
+            self.particles_x, self.particles_dx, self.weights
+        )
         screen_expected = expected_pos[0] * self.screen_size
+        std_x = math.sqrt(expected_var[0])
+        std_dx = math.sqrt(expected_var[1])
 
         # log one row
         self.logger.log(
-            t=time.time()-self.start_time,
+            t=self.t - self.start_time,
             true_x=self.x,
             true_dx=self.dx,
-            obs_x=np.nan if not self.observed else self.observed_x,
-            obs_speed=np.abs(self.dx),
+            obs_x=self.observation[0],
+            obs_speed=self.observation[1],
             est_x=expected_pos[0],
             est_dx=expected_pos[1],
-            std_x=np.sqrt(expected_var[0]),
-            std_dx=np.sqrt(expected_var[1]),
+            std_x=std_x,
+            std_dx=std_dx,
             mode=self.gilbert.state,
         )
 
-        screen_left_var = (
-            expected_pos[0] - np.sqrt(expected_var[0])
-        ) * self.screen_size
-        screen_right_var = (
-            expected_pos[0] + np.sqrt(expected_var[0])
-        ) * self.screen_size
+        screen_left_var = (expected_pos[0] - std_x) * self.screen_size
+        screen_right_var = (expected_pos[0] + std_x) * self.screen_size
 
         if self.show_block:
-
-            for std, height, stipple in [
-                (0.5, 0.75, "gray50"),
-                (1, 0.5, "gray25"),
-                (2, 0.25, "gray25"),
-            ]:
-                left = (
-                    expected_pos[0] - np.sqrt(expected_var[0]) * std
-                ) * self.screen_size
-                right = (
-                    expected_pos[0] + np.sqrt(expected_var[0]) * std
-                ) * self.screen_size
-                top = (0.5 - 0.5 * height) * self.slider_height
-                bottom = (0.5 + 0.5 * height) * self.slider_height
-
-                src.rectangle(
-                    left, top, right, bottom, fill="blue", stipple=stipple, width=0
-                )
+            lefts = (expected_pos[0] - std_x * self.block_stds) * self.screen_size
+            rights = (expected_pos[0] + std_x * self.block_stds) * self.screen_size
+            for item, left, right, top, bottom in zip(
+                self._block_ids, lefts, rights, self.block_tops, self.block_bottoms
+            ):
+                src.coords(item, left, top, right, bottom)
 
         if self.show_particles:
-            for particle, w in zip(self.particles, self.weights):
-                x = particle[0] * self.screen_size
-                x = x if np.isfinite(x) else 0
-                w = w if np.isfinite(w) else 0
-                src.circle(x, self.slider_height // 2, np.sqrt(w) * 20 + 1, fill="grey")
-
-            src.circle(screen_expected, self.slider_height // 2, 5, fill="blue")
-            src.line(
+            y = self.slider_height // 2
+            xs = np.where(np.isfinite(self.particles_x), self.particles_x, 0.0)
+            xs *= self.screen_size
+            ws = np.where(np.isfinite(self.weights), self.weights, 0.0)
+            rs = np.sqrt(ws, out=ws)
+            rs *= 20
+            rs += 1
+            bounds = np.stack([xs - rs, y - rs, xs + rs, y + rs], axis=1).tolist()
+            for item, bound in zip(self._particle_ids, bounds):
+                src.coords(item, *bound)
+
+            src.coords(
+                self._expected_id,
+                screen_expected - 5,
+                y - 5,
+                screen_expected + 5,
+                y + 5,
+            )
+            src.coords(
+                self._expected_line_id,
                 screen_expected,
                 0,
                 screen_expected,
                 self.slider_height,
-                fill="cyan",
-                width=2,
-            )
-
-            src.line(
-                screen_left_var,
-                0.25 * self.slider_height,
-                screen_left_var,
-                0.75 * self.slider_height,
-                fill="blue",
-            )
-            src.line(
-                screen_right_var,
-                0.25 * self.slider_height,
-                screen_right_var,
-                0.75 * self.slider_height,
-                fill="blue",
             )
+            for item, screen_var in zip(
+                self._var_line_ids, (screen_left_var, screen_right_var)
+            ):
+                src.coords(
+                    item,
+                    screen_var,
+                    0.25 * self.slider_height,
+                    screen_var,
+                    0.75 * self.slider_height,
+                )
 
         if self.observed:
             observed = self.observed_x * self.screen_size
-            src.line(observed, 0, observed, self.slider_height, fill="white", width=5)
+            src.coords(self._observed_id, observed, 0, observed, self.slider_height)
+        observed_state = "normal" if self.observed else "hidden"
+        if observed_state != self._observed_state:
+            src.modify(self._observed_id, state=observed_state)
+            self._observed_state = observed_state
 
 
 def create_slider():
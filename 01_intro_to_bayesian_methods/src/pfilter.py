@@ -8,17 +8,16 @@ def make_heat_adjusted(sigma):
     return heat_distance
 
 
-# resample function from http://scipy-cookbook.readthedocs.io/items/ParticleFilter.html
+# systematic resampling, as in http://scipy-cookbook.readthedocs.io/items/ParticleFilter.html
 def resample(weights):
+    """Return the indices of the particles to keep, given their weights.
+    Uses one uniform draw for n evenly spaced positions, so the whole pass
+    is a single sorted lookup into the cumulative weights."""
     n = len(weights)
-    indices = []
-    C = [0.0] + [np.sum(weights[: i + 1]) for i in range(n)]
-    u0, j = np.random.random(), 0
-    for u in [(u0 + i) / n for i in range(n)]:
-        while u > C[j]:
-            j += 1
-        indices.append(j - 1)
-    return indices
+    C = np.cumsum(weights)
+    # scale to the total so round-off can never step past the last particle
+    positions = (np.random.random() + np.arange(n)) * (C[-1] / n)
+    return np.searchsorted(C, positions)
 
 
 def no_dynamics(x):
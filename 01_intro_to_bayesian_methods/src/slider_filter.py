@@ -4,57 +4,61 @@ import pfilter
 
 def prior(n):
     """Return n initial draws from the prior over the position
-    and velocity of the cursor before any observations have been drawn"""
+    and velocity of the cursor before any observations have been drawn,
+    as two separate arrays (x, dx)"""
     x_prior = np.random.uniform(0, 1, n)  # anywhere 0->1
     dx_prior = np.random.normal(0, 0.2, n)  # slow movement
-    return np.stack([x_prior, dx_prior]).T
+    return x_prior, dx_prior
 
 
-def dynamics(particles, dt):
+def dynamics(xs, dxs, dt):
     """Apply our very simple dynamics, with velocity and some
-    random noise, and return a new set of particles"""
+    random noise, updating the particles in place"""
 
-    new_particles = np.array(particles)  # copy
-    new_particles[:, 0] += particles[:, 1] * dt  # integrate
+    xs += dxs * dt  # integrate
     # diffuse
-    new_particles += np.random.normal(0, 1, particles.shape) * [1e-2, 1e-1]
-    return new_particles
+    xs += np.random.normal(0, 1e-2, len(xs))
+    dxs += np.random.normal(0, 1e-1, len(dxs))
 
 
-def observation(particles):
+def observation(xs, dxs):
     """Project from 
     internal state (x, dx) => observed states (x, speed)"""
 
-    x = particles[:, 0]
-    speed = np.abs(particles[:, 1])
     # observations
-    return np.stack([x, speed]).T
+    return xs, np.abs(dxs)
 
 
-import numpy.ma as ma
-
-
-def weighting(hypothesised, real):
+def weighting(hyp_xs, hyp_speeds, real, out):
     """Compare a set of hypothesised observation values (one) real observation
-     and return a unnormalised weighting for each particle"""
+     and write a unnormalised weighting for each particle into ``out``"""
 
     # position, speed weights
-    # (note: these can be masked and therefore not contribute to the calculation)
+    # (note: the position can be NaN and therefore not contribute to the calculation)
     weights = [50.0, 10.0]
 
     # squared difference, weighted and exponentiated
     # this gives a similarity measure
-    difference = np.nansum((hypothesised - real) ** 2 * weights, axis=1)
-    weight = np.exp(-difference)
-    
-    weight[hypothesised[:,0]<0] = 0.0
-    weight[hypothesised[:,0]>1] = 0.0
-    return weight + 1e-6
+    np.subtract(hyp_speeds, real[1], out=out)
+    np.square(out, out=out)
+    out *= weights[1]
+    if np.isfinite(real[0]):
+        out += (hyp_xs - real[0]) ** 2 * weights[0]
+    np.negative(out, out=out)
+    np.exp(out, out=out)
 
+    out[hyp_xs<0] = 0.0
+    out[hyp_xs>1] = 0.0
+    out += 1e-6
+    return out
 
-def filter_step(particles, observed, dt=0.01, prior_rate=0.05):
+
+def filter_step(xs, dxs, weights, observed, dt=0.01, prior_rate=0.05):
     """Update one complete step given a set of particles
-    and an observation.
+    and an observation. The particles are given as two arrays
+    of positions ``xs`` and velocities ``dxs``, which are
+    overwritten in place with the resampled particles; the
+    normalised weights are written into ``weights``.
     
         Steps:
         * Apply dynamics to the particles
@@ -66,31 +70,37 @@ def filter_step(particles, observed, dt=0.01, prior_rate=0.05):
 
     """
 
-    new_particles = dynamics(particles, dt)  # dynamics
+    dynamics(xs, dxs, dt)  # dynamics
 
     # replace a few particles with draws from the posterior
-    prior_draws = np.random.uniform(0, 1, len(particles)) < prior_rate
-    new_particles[prior_draws] = prior(np.sum(prior_draws))
-
-    weights = weighting(observation(new_particles), observed)  # weighting
-    normalised_weights = weights / np.sum(weights)  # normalise weights
+    prior_draws = np.random.uniform(0, 1, len(xs)) < prior_rate
+    n_prior = np.count_nonzero(prior_draws)
+    if n_prior:
+        xs[prior_draws], dxs[prior_draws] = prior(n_prior)
 
-    n_eff = (1.0 / np.sum(normalised_weights ** 2)) / len(particles)
-    
-    
+    weighting(*observation(xs, dxs), observed, out=weights)  # weighting
+    weights /= np.sum(weights)  # normalise weights
 
-    new_particles = new_particles[pfilter.resample(normalised_weights)]  # resampling
+    # resampling; take() buffers its output, so this is safe in place
+    indices = pfilter.resample(weights)
+    np.take(xs, indices, out=xs)
+    np.take(dxs, indices, out=dxs)
 
-    return new_particles, normalised_weights
+    return weights
 
 
-def expected_position(particles, normalised_weights):
+def expected_position(xs, dxs, normalised_weights):
     """Return the expectation of the particle position/speed"""
-    return np.sum((particles.T * normalised_weights.T).T, axis=0)
-
-
-def variance_position(particles, weights):
-    ex_pos = expected_position(particles, weights)
-    sqr_dif = (ex_pos - particles) ** 2
-    return np.sum((sqr_dif.T * weights.T).T, axis=0)
-
+    return np.dot(xs, normalised_weights), np.dot(dxs, normalised_weights)
+
+
+def mean_variance(xs, dxs, weights):
+    """Return the expectation and the variance of the particle position/speed
+    together, as ((mean_x, mean_dx), (var_x, var_dx))"""
+    ex_x, ex_dx = expected_position(xs, dxs, weights)
+    dev_x = xs - ex_x
+    dev_dx = dxs - ex_dx
+    return (
+        (ex_x, ex_dx),
+        (np.dot(dev_x * dev_x, weights), np.dot(dev_dx * dev_dx, weights)),
+    )
@@ -94,6 +94,9 @@ class TKanvas(object):
     def delete(self, tagOrId):
         self.canvas.delete(tagOrId)
 
+    def coords(self, tagOrId, *coords):
+        self.canvas.coords(tagOrId, *coords)
+
     def event(self, event_type, event):
         if event_type == "mousemotion":
             # track mouse offset